@@ -1,19 +1,42 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 import json
 import asyncio
-from typing import List, Optional
+from datetime import datetime
+from typing import List, Optional, Set
 import uvicorn
 
-from models import PacketData, PacketResponse, CaptureStatus
-from packet_capture import packet_capture
+from models import PacketResponse, CaptureStatus
+from packet_capture import packet_capture, PacketRecord
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(obj):
+    """Fallback serializer for values the JSON encoder does not handle"""
+    if isinstance(obj, PacketRecord):
+        # Only reached by stdlib json; orjson serializes dataclasses natively
+        return obj.to_dict()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps(obj) -> bytes:
+    """Serialize an object to UTF-8 JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default).encode("utf-8")
 
 # Create FastAPI app
 app = FastAPI(
     title="Packet Sniffer API",
     description="Real-time network packet capture and analysis API",
-    version="1.0.0"
+    version="1.0.0",
+    # Serialize responses with orjson when it is installed
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse
 )
 
 # Configure CORS for frontend
@@ -25,49 +48,124 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Seconds a client may take to accept a message before it is dropped
+SEND_TIMEOUT = 1.0
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
-    async def send_packet(self, packet: PacketData):
-        """Send packet data to all connected WebSocket clients"""
+    async def send_packets(self, packets: List[PacketRecord]):
+        """Send a batch of packets to all connected WebSocket clients"""
         if self.active_connections:
-            packet_dict = packet.dict()
-            packet_dict["timestamp"] = packet_dict["timestamp"].isoformat()
+            # Serialize once and send the same bytes to all connections
+            payload = (
+                b'{"type":"batch","packets":['
+                + b",".join(packet.to_json(dumps) for packet in packets)
+                + b"]}"
+            )
             
-            # Convert to JSON and send to all connections
-            message = json.dumps(packet_dict)
-            disconnected = []
+            # Send to all connections concurrently so one slow client doesn't delay the others
+            connections = tuple(self.active_connections)
+            results = await asyncio.gather(
+                *(asyncio.wait_for(connection.send_bytes(payload), SEND_TIMEOUT)
+                  for connection in connections),
+                return_exceptions=True
+            )
             
-            for connection in self.active_connections:
-                try:
-                    await connection.send_text(message)
-                except:
-                    disconnected.append(connection)
-            
-            # Remove disconnected clients
-            for connection in disconnected:
+            # Remove and close disconnected or stalled clients so they reconnect
+            dropped = [
+                connection for connection, result in zip(connections, results)
+                if isinstance(result, Exception)
+            ]
+            for connection in dropped:
                 self.disconnect(connection)
+            if dropped:
+                await asyncio.gather(
+                    *(asyncio.wait_for(connection.close(code=1011), SEND_TIMEOUT)
+                      for connection in dropped),
+                    return_exceptions=True
+                )
 
 manager = ConnectionManager()
 
+# Maximum number of queued packets sent in a single WebSocket message
+MAX_BATCH_SIZE = 100
+# Seconds to wait for more packets to coalesce into a batch
+BATCH_WINDOW = 0.01
+# Maximum number of packets waiting to be broadcast; newer packets are dropped beyond this
+MAX_QUEUED_PACKETS = 10000
+
+# Event loop and queue used to hand packets from the capture thread to the broadcaster
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+packet_queue: Optional[asyncio.Queue] = None
+broadcaster_task: Optional[asyncio.Task] = None
+# Packets dropped because the broadcast queue was full
+dropped_packets = 0
+
 # WebSocket callback for packet streaming
-def packet_callback(packet: PacketData):
-    """Callback function to send packets to WebSocket clients"""
-    asyncio.create_task(manager.send_packet(packet))
+def packet_callback(packet: PacketRecord):
+    """Callback function to queue packets for WebSocket clients (runs in the decoder thread)"""
+    if event_loop is not None and manager.active_connections:
+        event_loop.call_soon_threadsafe(enqueue_packet, packet)
+
+def enqueue_packet(packet: PacketRecord):
+    """Queue a packet for broadcast, dropping it if clients can't keep up"""
+    global dropped_packets
+    try:
+        packet_queue.put_nowait(packet)
+    except asyncio.QueueFull:
+        dropped_packets += 1
+
+async def broadcast_packets(queue: asyncio.Queue):
+    """Drain queued packets and broadcast them in batches"""
+    loop = asyncio.get_running_loop()
+    while True:
+        pending = [await queue.get()]
+        
+        # Let more packets arrive so they share one WebSocket frame,
+        # unless a full batch is already waiting
+        deadline = loop.time() + BATCH_WINDOW
+        if queue.qsize() + 1 < MAX_BATCH_SIZE:
+            await asyncio.sleep(max(0, deadline - loop.time()))
+        
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+        
+        # Send everything that is queued, split into frames of at most MAX_BATCH_SIZE
+        for start in range(0, len(pending), MAX_BATCH_SIZE):
+            try:
+                await manager.send_packets(pending[start:start + MAX_BATCH_SIZE])
+            except Exception as e:
+                print(f"Broadcast error: {e}")
 
 # Add callback to packet capture
 packet_capture.add_callback(packet_callback)
 
+@app.on_event("startup")
+async def start_broadcaster():
+    """Start the packet broadcaster on the server event loop"""
+    global event_loop, packet_queue, broadcaster_task
+    event_loop = asyncio.get_running_loop()
+    packet_queue = asyncio.Queue(maxsize=MAX_QUEUED_PACKETS)
+    broadcaster_task = asyncio.create_task(broadcast_packets(packet_queue))
+
+@app.on_event("shutdown")
+async def stop_broadcaster():
+    """Stop the packet broadcaster"""
+    global event_loop
+    event_loop = None
+    if broadcaster_task:
+        broadcaster_task.cancel()
+
 @app.get("/")
 async def root():
     """Root endpoint with API information"""
@@ -100,11 +198,16 @@ async def get_packets(
         total_count = len(packet_capture.packets)
         filtered_count = len(packets)
         
-        return PacketResponse(
-            packets=packets,
-            total_count=total_count,
-            filtered_count=filtered_count
+        # Records are already well-formed, so reuse their cached JSON
+        # instead of validating them into PacketResponse
+        content = (
+            b'{"packets":['
+            + b",".join(packet.to_json(dumps) for packet in packets)
+            + b'],"total_count":' + str(total_count).encode()
+            + b',"filtered_count":' + str(filtered_count).encode()
+            + b"}"
         )
+        return Response(content=content, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving packets: {str(e)}")
 
@@ -116,7 +219,8 @@ async def get_capture_status():
         return CaptureStatus(
             is_capturing=status["is_capturing"],
             packets_captured=status["packets_captured"],
-            capture_start_time=status["capture_start_time"]
+            capture_start_time=status["capture_start_time"],
+            dropped_packets=dropped_packets
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving status: {str(e)}")
@@ -185,7 +289,8 @@ async def websocket_packets(websocket: WebSocket):
     try:
         # Send initial status
         status = packet_capture.get_status()
-        await websocket.send_text(json.dumps({
+        status["dropped_packets"] = dropped_packets
+        await websocket.send_bytes(dumps({
             "type": "status",
             "data": status
         }))
@@ -199,7 +304,7 @@ async def websocket_packets(websocket: WebSocket):
             try:
                 message = json.loads(data)
                 if message.get("type") == "ping":
-                    await websocket.send_text(json.dumps({"type": "pong"}))
+                    await websocket.send_bytes(dumps({"type": "pong"}))
             except json.JSONDecodeError:
                 # Ignore non-JSON messages
                 pass
@@ -25,6 +25,7 @@ class CaptureStatus(BaseModel):
     is_capturing: bool
     packets_captured: int
     capture_start_time: Optional[datetime] = None
+    dropped_packets: int = 0
 
 class FilterParams(BaseModel):
     """Model for packet filtering parameters"""
@@ -1,36 +1,183 @@
+import os
+import queue
+import socket
+import struct
+import sys
 import threading
 import time
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List, Optional, Callable
+from functools import lru_cache, partial
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Callable
 from scapy.all import sniff, IP, TCP, UDP, ICMP
-from models import PacketData
+from scapy.error import Scapy_Exception
+
+try:
+    # Optional compiled decoder, built with: cythonize -i packet_decode.pyx
+    import packet_decode
+except ImportError:
+    packet_decode = None
+
+@dataclass(slots=True)
+class PacketRecord:
+    """Lightweight packet record used on the capture hot path (no validation)"""
+    timestamp: datetime
+    source_ip: str
+    destination_ip: str
+    protocol: str
+    packet_size: int
+    source_port: Optional[int] = None
+    destination_port: Optional[int] = None
+    ttl: Optional[int] = None
+    flags: Optional[str] = None
+    # Serialized form, filled in on first use by to_json(). The leading
+    # underscore keeps orjson from serializing it with the other fields.
+    _json_cache: Optional[bytes] = field(default=None, repr=False, compare=False)
+
+    def to_dict(self) -> dict:
+        """Convert record to a plain dict"""
+        return {
+            "timestamp": self.timestamp,
+            "source_ip": self.source_ip,
+            "destination_ip": self.destination_ip,
+            "protocol": self.protocol,
+            "packet_size": self.packet_size,
+            "source_port": self.source_port,
+            "destination_port": self.destination_port,
+            "ttl": self.ttl,
+            "flags": self.flags
+        }
+
+    def to_json(self, encoder: Callable[["PacketRecord"], bytes]) -> bytes:
+        """Serialize record with encoder, caching the result (records are never mutated)"""
+        if self._json_cache is None:
+            self._json_cache = encoder(self)
+        return self._json_cache
+
+# TCP flag bits in display order
+_TCP_FLAG_BITS = (
+    (0x01, "FIN"),
+    (0x02, "SYN"),
+    (0x04, "RST"),
+    (0x08, "PSH"),
+    (0x10, "ACK"),
+    (0x20, "URG")
+)
+
+def _format_tcp_flags(flags: int) -> Optional[str]:
+    """Format TCP flag bits as a string"""
+    names = [name for bit, name in _TCP_FLAG_BITS if flags & bit]
+    return ", ".join(names) if names else None
+
+# Precomputed flag string for every possible flags byte
+_TCP_FLAG_TABLE = tuple(_format_tcp_flags(i) for i in range(256))
+
+# Capture with a raw AF_PACKET socket instead of Scapy (Linux only, needs CAP_NET_RAW)
+USE_RAW_SOCKET = os.environ.get("USE_RAW_SOCKET", "").lower() in ("1", "true", "yes")
+
+ETH_P_IP = 0x0800
+# Link-layer header length by ARPHRD device type, used to report the same
+# packet sizes as Scapy; devices without a link header (tun, PPP, ...) add 0
+_LINK_HDR_LEN = {1: 14, 772: 14}  # ARPHRD_ETHER, ARPHRD_LOOPBACK
+_IP_HDR = struct.Struct("!BBHHHBBH4s4s")
+_PORTS = struct.Struct("!HH")
+_IP_PROTOCOLS = {6: "TCP", 17: "UDP", 1: "ICMP"}
+
+# Cached address strings so packets between the same endpoints share one str
+_ADDRESS_CACHE_SIZE = 4096
+_intern_address = lru_cache(maxsize=_ADDRESS_CACHE_SIZE)(sys.intern)
+_inet_ntoa = lru_cache(maxsize=_ADDRESS_CACHE_SIZE)(socket.inet_ntoa)
+
+def parse_frame(data: bytes, link_header_len: int = 0) -> Optional[PacketRecord]:
+    """Parse an IPv4 datagram (link-layer header already stripped) into a packet record"""
+    (version_ihl, _, _, _, fragment, ttl, ip_proto, _,
+     src, dst) = _IP_HDR.unpack_from(data)
+    if version_ihl >> 4 != 4:
+        return None
+    
+    protocol = _IP_PROTOCOLS.get(ip_proto, "IP")
+    source_port = None
+    destination_port = None
+    flags = None
+    
+    # Only the first fragment carries the transport header
+    if protocol != "IP" and not fragment & 0x1FFF:
+        l4_offset = (version_ihl & 0x0F) * 4
+        if protocol == "TCP":
+            source_port, destination_port = _PORTS.unpack_from(data, l4_offset)
+            flags = _TCP_FLAG_TABLE[data[l4_offset + 13]]
+        elif protocol == "UDP":
+            source_port, destination_port = _PORTS.unpack_from(data, l4_offset)
+    
+    return PacketRecord(
+        timestamp=datetime.now(),
+        source_ip=_inet_ntoa(src),
+        destination_ip=_inet_ntoa(dst),
+        protocol=protocol,
+        packet_size=len(data) + link_header_len,
+        source_port=source_port,
+        destination_port=destination_port,
+        ttl=ttl,
+        flags=flags
+    )
+
+# Prefer the compiled decoder when it has been built
+if packet_decode is not None:
+    parse_frame = partial(packet_decode.parse_frame, PacketRecord, _TCP_FLAG_TABLE, _inet_ntoa)
+
+# Maximum number of queued packets decoded and stored per lock acquisition
+DECODE_BATCH_SIZE = 64
 
 class PacketCapture:
     """Handles real-time packet capture using Scapy"""
     
     def __init__(self, max_packets: int = 1000):
         self.max_packets = max_packets
-        self.packets: List[PacketData] = []
+        # Ring buffer of the most recent packets. Written only by the decoder
+        # thread; readers take self._lock to get a consistent snapshot.
+        self.packets: Deque[PacketRecord] = deque(maxlen=max_packets)
+        # Per-field indexes over self.packets, each bucket in capture order
+        self._by_protocol: Dict[str, Deque[PacketRecord]] = {}
+        self._by_source_ip: Dict[str, Deque[PacketRecord]] = {}
+        self._by_destination_ip: Dict[str, Deque[PacketRecord]] = {}
         self.is_capturing = False
         self.capture_thread: Optional[threading.Thread] = None
+        self.decoder_thread: Optional[threading.Thread] = None
+        self._raw_queue: Optional[queue.SimpleQueue] = None
+        # Set to stop the current capture session's threads
+        self._stop_event: Optional[threading.Event] = None
         self.capture_start_time: Optional[datetime] = None
-        self.packet_callbacks: List[Callable[[PacketData], None]] = []
+        self.packet_callbacks: List[Callable[[PacketRecord], None]] = []
         self._lock = threading.Lock()
     
     def start_capture(self, interface: str = None) -> bool:
-        """Start packet capture in a background thread"""
+        """Start packet capture and decoding in background threads"""
         if self.is_capturing:
             return False
         
         self.is_capturing = True
         self.capture_start_time = datetime.now()
         
+        # Captured packets are handed to the decoder thread through this queue.
+        # Each session gets its own queue and stop event, so a capture thread
+        # still winding down after a pause can't outlive a resumed session.
+        raw_queue = self._raw_queue = queue.SimpleQueue()
+        stop_event = self._stop_event = threading.Event()
+        
         # Start capture in background thread
         self.capture_thread = threading.Thread(
             target=self._capture_packets,
-            args=(interface,),
+            args=(raw_queue, stop_event, interface),
+            daemon=True
+        )
+        self.decoder_thread = threading.Thread(
+            target=self._decode_packets,
+            args=(raw_queue,),
             daemon=True
         )
+        self.decoder_thread.start()
         self.capture_thread.start()
         return True
     
@@ -40,8 +187,11 @@ class PacketCapture:
             return False
         
         self.is_capturing = False
+        self._stop_session()
         if self.capture_thread:
             self.capture_thread.join(timeout=2)
+        if self.decoder_thread:
+            self.decoder_thread.join(timeout=2)
         return True
     
     def pause_capture(self) -> bool:
@@ -50,6 +200,7 @@ class PacketCapture:
             return False
         
         self.is_capturing = False
+        self._stop_session()
         return True
     
     def resume_capture(self, interface: str = None) -> bool:
@@ -59,143 +210,246 @@ class PacketCapture:
         
         return self.start_capture(interface)
     
-    def _capture_packets(self, interface: str = None):
+    def _stop_session(self):
+        """Signal the current capture session's threads to exit"""
+        if self._stop_event is not None:
+            self._stop_event.set()
+        # Scapy's sniff only returns after the next packet arrives, so the
+        # capture thread's own sentinel can come much later on a quiet interface
+        if self._raw_queue is not None:
+            self._raw_queue.put(None)
+    
+    def _capture_packets(self, raw_queue: queue.SimpleQueue, stop_event: threading.Event,
+                         interface: str = None):
         """Background thread function for packet capture"""
         try:
-            # Start sniffing packets
-            sniff(
-                iface=interface,
-                prn=self._process_packet,
-                store=False,
-                stop_filter=lambda _: not self.is_capturing
-            )
+            if USE_RAW_SOCKET:
+                self._capture_raw(raw_queue, stop_event, interface)
+            else:
+                try:
+                    # The BPF filter drops non-IPv4 frames in the kernel
+                    self._sniff(raw_queue, stop_event, interface, capture_filter="ip")
+                except Scapy_Exception as e:
+                    # Compiling the filter needs libpcap or tcpdump; without
+                    # them, non-IP frames are dropped by the decoder instead
+                    print(f"Capture filter unavailable, capturing unfiltered: {e}")
+                    self._sniff(raw_queue, stop_event, interface)
         except Exception as e:
             print(f"Packet capture error: {e}")
-            self.is_capturing = False
+            # Only end the session this thread belongs to
+            if self._stop_event is stop_event:
+                self.is_capturing = False
+        finally:
+            # Tell the decoder thread to exit
+            raw_queue.put(None)
     
-    def _process_packet(self, packet):
-        """Process and store captured packet"""
-        if not self.is_capturing:
-            return
-        
+    def _sniff(self, raw_queue: queue.SimpleQueue, stop_event: threading.Event,
+               interface: str = None, capture_filter: Optional[str] = None):
+        """Sniff packets with Scapy; decoding happens in the decoder thread"""
+        sniff(
+            filter=capture_filter,
+            iface=interface,
+            prn=raw_queue.put,
+            store=False,
+            stop_filter=lambda _: stop_event.is_set()
+        )
+    
+    def _capture_raw(self, raw_queue: queue.SimpleQueue, stop_event: threading.Event,
+                     interface: str = None):
+        """Capture IPv4 packets from an AF_PACKET socket"""
+        # SOCK_DGRAM strips the link-layer header on every device type, so the
+        # IP header is always at offset 0
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+        # Wake up periodically to check whether capture was stopped
+        sock.settimeout(1.0)
         try:
-            # Extract IP layer
-            if IP not in packet:
-                return
-            
-            ip_layer = packet[IP]
-            
-            # Determine protocol
-            protocol = "IP"
-            source_port = None
-            destination_port = None
-            ttl = ip_layer.ttl
-            flags = None
-            
-            # Check for TCP
-            if TCP in packet:
-                protocol = "TCP"
-                tcp_layer = packet[TCP]
-                source_port = tcp_layer.sport
-                destination_port = tcp_layer.dport
-                flags = self._get_tcp_flags(tcp_layer)
-            
-            # Check for UDP
-            elif UDP in packet:
-                protocol = "UDP"
-                udp_layer = packet[UDP]
-                source_port = udp_layer.sport
-                destination_port = udp_layer.dport
+            if interface:
+                sock.bind((interface, 0))
             
-            # Check for ICMP
-            elif ICMP in packet:
-                protocol = "ICMP"
-            
-            # Create packet data object
-            packet_data = PacketData(
-                timestamp=datetime.now(),
-                source_ip=ip_layer.src,
-                destination_ip=ip_layer.dst,
-                protocol=protocol,
-                packet_size=len(packet),
-                source_port=source_port,
-                destination_port=destination_port,
-                ttl=ttl,
-                flags=flags
-            )
+            while not stop_event.is_set():
+                try:
+                    data, address = sock.recvfrom(65535)
+                    raw_queue.put((data, _LINK_HDR_LEN.get(address[3], 0)))
+                except socket.timeout:
+                    continue
+        finally:
+            sock.close()
+    
+    def _decode_packets(self, raw_queue: queue.SimpleQueue):
+        """Background thread function that decodes and stores captured packets"""
+        running = True
+        while running:
+            # Block for one packet, then take whatever else is already queued
+            batch = [raw_queue.get()]
+            try:
+                while len(batch) < DECODE_BATCH_SIZE:
+                    batch.append(raw_queue.get_nowait())
+            except queue.Empty:
+                pass
             
-            # Store packet with thread safety
-            with self._lock:
-                self.packets.append(packet_data)
+            records = []
+            for packet in batch:
+                if packet is None:
+                    running = False
+                    break
+                
+                try:
+                    if USE_RAW_SOCKET:
+                        packet_data = parse_frame(*packet)
+                    else:
+                        packet_data = self._decode_packet(packet)
+                except Exception as e:
+                    print(f"Error processing packet: {e}")
+                    continue
                 
-                # Maintain max packet limit
-                if len(self.packets) > self.max_packets:
-                    self.packets.pop(0)
+                if packet_data is not None:
+                    records.append(packet_data)
             
-            # Notify callbacks (for WebSocket streaming)
+            if records:
+                self._add_packets(records)
+    
+    def _decode_packet(self, packet) -> Optional[PacketRecord]:
+        """Decode a Scapy packet into a packet record"""
+        # Extract IP layer (missing only when the capture filter is unavailable)
+        if IP not in packet:
+            return None
+        
+        ip_layer = packet[IP]
+        
+        # Determine protocol
+        protocol = "IP"
+        source_port = None
+        destination_port = None
+        ttl = ip_layer.ttl
+        flags = None
+        
+        # Check for TCP
+        if TCP in packet:
+            protocol = "TCP"
+            tcp_layer = packet[TCP]
+            source_port = tcp_layer.sport
+            destination_port = tcp_layer.dport
+            flags = _TCP_FLAG_TABLE[int(tcp_layer.flags) & 0xFF]
+        
+        # Check for UDP
+        elif UDP in packet:
+            protocol = "UDP"
+            udp_layer = packet[UDP]
+            source_port = udp_layer.sport
+            destination_port = udp_layer.dport
+        
+        # Check for ICMP
+        elif ICMP in packet:
+            protocol = "ICMP"
+        
+        return PacketRecord(
+            timestamp=datetime.now(),
+            source_ip=_intern_address(ip_layer.src),
+            destination_ip=_intern_address(ip_layer.dst),
+            protocol=protocol,
+            packet_size=len(packet),
+            source_port=source_port,
+            destination_port=destination_port,
+            ttl=ttl,
+            flags=flags
+        )
+    
+    def _add_packets(self, records: List[PacketRecord]):
+        """Store decoded packets and notify callbacks"""
+        if not self.is_capturing:
+            return
+        
+        # Store the whole batch under a single lock acquisition
+        with self._lock:
+            for packet_data in records:
+                self._store_packet(packet_data)
+        
+        # Notify callbacks (for WebSocket streaming)
+        for packet_data in records:
             for callback in self.packet_callbacks:
                 try:
                     callback(packet_data)
                 except Exception as e:
                     print(f"Callback error: {e}")
-                    
-        except Exception as e:
-            print(f"Error processing packet: {e}")
-    
-    def _get_tcp_flags(self, tcp_layer) -> str:
-        """Extract TCP flags as string"""
-        flags = []
-        if tcp_layer.flags & 0x01:  # FIN
-            flags.append("FIN")
-        if tcp_layer.flags & 0x02:  # SYN
-            flags.append("SYN")
-        if tcp_layer.flags & 0x04:  # RST
-            flags.append("RST")
-        if tcp_layer.flags & 0x08:  # PSH
-            flags.append("PSH")
-        if tcp_layer.flags & 0x10:  # ACK
-            flags.append("ACK")
-        if tcp_layer.flags & 0x20:  # URG
-            flags.append("URG")
-        return ", ".join(flags) if flags else None
+    
+    def _store_packet(self, packet: PacketRecord):
+        """Append packet to the ring buffer and indexes (caller holds the lock)"""
+        # Evict explicitly so the oldest packet can be dropped from the indexes
+        if len(self.packets) >= self.max_packets:
+            oldest = self.packets.popleft()
+            self._unindex(self._by_protocol, oldest.protocol)
+            self._unindex(self._by_source_ip, oldest.source_ip)
+            self._unindex(self._by_destination_ip, oldest.destination_ip)
+        
+        self.packets.append(packet)
+        self._by_protocol.setdefault(packet.protocol, deque()).append(packet)
+        self._by_source_ip.setdefault(packet.source_ip, deque()).append(packet)
+        self._by_destination_ip.setdefault(packet.destination_ip, deque()).append(packet)
+    
+    @staticmethod
+    def _unindex(index: Dict[str, Deque[PacketRecord]], key: str):
+        """Drop the oldest packet from an index bucket"""
+        # The evicted packet is always the oldest, i.e. leftmost, in its bucket
+        bucket = index[key]
+        bucket.popleft()
+        if not bucket:
+            del index[key]
     
     def get_packets(self, 
                    protocol: Optional[str] = None,
                    source_ip: Optional[str] = None,
                    destination_ip: Optional[str] = None,
-                   limit: int = 100) -> List[PacketData]:
+                   limit: int = 100) -> List[PacketRecord]:
         """Get filtered packets"""
+        if protocol:
+            protocol = protocol.upper()
+        
+        filters = [
+            (self._by_protocol, protocol),
+            (self._by_source_ip, source_ip),
+            (self._by_destination_ip, destination_ip)
+        ]
+        filters = [(index, key) for index, key in filters if key]
+        
         with self._lock:
-            filtered_packets = self.packets.copy()
+            if filters:
+                buckets = [index.get(key) for index, key in filters]
+                if not all(buckets):
+                    return []
+                # Start from the smallest matching bucket
+                filtered_packets = list(min(buckets, key=len))
+            else:
+                filtered_packets = list(self.packets)
         
-        # Apply filters
+        # Apply remaining filters lazily, newest first, stopping once limit packets match
+        matches = reversed(filtered_packets)
         if protocol:
-            filtered_packets = [p for p in filtered_packets if p.protocol.upper() == protocol.upper()]
+            matches = (p for p in matches if p.protocol == protocol)
         
         if source_ip:
-            filtered_packets = [p for p in filtered_packets if p.source_ip == source_ip]
+            matches = (p for p in matches if p.source_ip == source_ip)
         
         if destination_ip:
-            filtered_packets = [p for p in filtered_packets if p.destination_ip == destination_ip]
+            matches = (p for p in matches if p.destination_ip == destination_ip)
         
-        # Apply limit and return most recent packets
-        return filtered_packets[-limit:] if limit else filtered_packets
+        # Return most recent packets in capture order
+        return list(islice(matches, limit or None))[::-1]
     
     def get_status(self) -> dict:
         """Get current capture status"""
-        with self._lock:
-            return {
-                "is_capturing": self.is_capturing,
-                "packets_captured": len(self.packets),
-                "capture_start_time": self.capture_start_time,
-                "max_packets": self.max_packets
-            }
-    
-    def add_callback(self, callback: Callable[[PacketData], None]):
+        # len() of a deque is atomic, so no lock is needed here
+        return {
+            "is_capturing": self.is_capturing,
+            "packets_captured": len(self.packets),
+            "capture_start_time": self.capture_start_time,
+            "max_packets": self.max_packets
+        }
+    
+    def add_callback(self, callback: Callable[[PacketRecord], None]):
         """Add callback for new packet notifications"""
         self.packet_callbacks.append(callback)
     
-    def remove_callback(self, callback: Callable[[PacketData], None]):
+    def remove_callback(self, callback: Callable[[PacketRecord], None]):
         """Remove callback"""
         if callback in self.packet_callbacks:
             self.packet_callbacks.remove(callback)
@@ -204,6 +458,9 @@ class PacketCapture:
         """Clear stored packets"""
         with self._lock:
             self.packets.clear()
+            self._by_protocol.clear()
+            self._by_source_ip.clear()
+            self._by_destination_ip.clear()
 
 # Global packet capture instance
 packet_capture = PacketCapture()
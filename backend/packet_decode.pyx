@@ -0,0 +1,65 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled IPv4 decoder for the raw socket capture path
+
+Optional: packet_capture falls back to its pure Python parse_frame when this
+module is not built. Build in place with: cythonize -i packet_decode.pyx
+"""
+from datetime import datetime
+
+cdef Py_ssize_t IP_HDR_MIN_LEN = 20
+
+cpdef object parse_frame(object record_type, tuple flag_table, object ntoa,
+                         bytes data, Py_ssize_t link_header_len=0):
+    """Parse an IPv4 datagram (link-layer header already stripped) into a record_type instance"""
+    cdef const unsigned char* buf = data
+    cdef Py_ssize_t length = len(data)
+    cdef Py_ssize_t l4_offset
+    cdef unsigned char version_ihl
+    cdef unsigned char ip_proto
+    cdef unsigned int fragment
+
+    if length < IP_HDR_MIN_LEN:
+        raise ValueError("Truncated IPv4 header")
+
+    version_ihl = buf[0]
+    if version_ihl >> 4 != 4:
+        return None
+
+    fragment = ((buf[6] << 8) | buf[7]) & 0x1FFF
+    ttl = buf[8]
+    ip_proto = buf[9]
+
+    protocol = "IP"
+    source_port = None
+    destination_port = None
+    flags = None
+
+    if ip_proto == 6:
+        protocol = "TCP"
+    elif ip_proto == 17:
+        protocol = "UDP"
+    elif ip_proto == 1:
+        protocol = "ICMP"
+
+    # Only the first fragment carries the transport header
+    if (ip_proto == 6 or ip_proto == 17) and fragment == 0:
+        l4_offset = (version_ihl & 0x0F) * 4
+        if length < l4_offset + (14 if ip_proto == 6 else 4):
+            raise ValueError("Truncated transport header")
+
+        source_port = (buf[l4_offset] << 8) | buf[l4_offset + 1]
+        destination_port = (buf[l4_offset + 2] << 8) | buf[l4_offset + 3]
+        if ip_proto == 6:
+            flags = flag_table[buf[l4_offset + 13]]
+
+    return record_type(
+        timestamp=datetime.now(),
+        source_ip=ntoa(data[12:16]),
+        destination_ip=ntoa(data[16:20]),
+        protocol=protocol,
+        packet_size=length + link_header_len,
+        source_port=source_port,
+        destination_port=destination_port,
+        ttl=ttl,
+        flags=flags
+    )
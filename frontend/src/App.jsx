@@ -4,6 +4,7 @@ import PacketTable from './components/PacketTable'
 // Configuration
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 const WS_BASE_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:8000'
+const textDecoder = new TextDecoder()
 
 function App() {
   const [packets, setPackets] = useState([])
@@ -25,6 +26,8 @@ function App() {
   const connectWebSocket = useCallback(() => {
     try {
       const ws = new WebSocket(`${WS_BASE_URL}/ws/packets`)
+      // Server sends JSON as binary frames
+      ws.binaryType = 'arraybuffer'
       
       ws.onopen = () => {
         console.log('WebSocket connected')
@@ -34,18 +37,21 @@ function App() {
       
       ws.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data)
+          const text = typeof event.data === 'string'
+            ? event.data
+            : textDecoder.decode(event.data)
+          const data = JSON.parse(text)
           
           if (data.type === 'status') {
             setCaptureStatus(data.data)
-          } else {
-            // New packet data
-            const newPacket = {
-              ...data,
-              timestamp: new Date(data.timestamp)
-            }
+          } else if (data.type === 'batch') {
+            // Batch of new packets
+            const newPackets = data.packets.map(packet => ({
+              ...packet,
+              timestamp: new Date(packet.timestamp)
+            }))
             setPackets(prev => {
-              const updated = [...prev, newPacket]
+              const updated = [...prev, ...newPackets]
               // Keep only last 1000 packets
               return updated.slice(-1000)
             })